@@ -0,0 +1,4 @@
+from edit_lib import \
+    *
+
+print(alpha)
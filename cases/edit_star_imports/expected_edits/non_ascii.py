@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+name = 'é'; from edit_lib import beta
+
+print(name, beta)
@@ -0,0 +1,3 @@
+from edit_lib import alpha, gamma
+
+print(alpha, gamma)
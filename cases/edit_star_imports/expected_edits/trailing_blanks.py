@@ -0,0 +1,3 @@
+from edit_lib import gamma
+
+print(gamma)
@@ -0,0 +1 @@
+delta = 4
@@ -0,0 +1,2 @@
+epsilon = 5
+zeta = 6
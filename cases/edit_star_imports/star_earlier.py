@@ -0,0 +1,3 @@
+x = 2*3; from edit_lib import *
+
+print(x * alpha)
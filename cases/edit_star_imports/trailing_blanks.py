@@ -0,0 +1,4 @@
+from edit_lib import *   
+from other_lib import *	
+
+print(gamma)
@@ -0,0 +1,12 @@
+if True:
+    import b
+
+def f(x=[i for i in range(3)]):
+    from c import y
+    return y
+
+class C:
+    try:
+        from b import x as z
+    except ImportError:
+        pass
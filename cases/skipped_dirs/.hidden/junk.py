@@ -0,0 +1,3 @@
+import a
+
+z = a.x
@@ -0,0 +1,3 @@
+import a
+
+y = a.x
@@ -32,52 +32,159 @@ the same version of Python that your code is written for.  `PYTHONPATH` should
 also be set as it would be set during a normal run of your code; it will be
 used to find other modules that your code imports.
 
+Scan results are cached under `$XDG_CACHE_HOME/star-destroyer` (by default
+`~/.cache/star-destroyer`) so that unchanged files aren't parsed again on the
+next run.  Delete that directory to start from scratch, or run with the
+`--no-cache` option to neither use nor update it.
+
 To run the tests, execute `py.test` using Python 2.7 or Python 3.5.
 """
 
 from __future__ import print_function
 import ast
 import importlib
+import itertools
+import multiprocessing
 import os
+import pickle
 import sys
+import tempfile
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None  # not available in Python 2
+
+try:
+    from sys import intern
+except ImportError:
+    pass  # Python 2 has intern() as a builtin
 
 __version__ = '1.0'
 
-def node_type(node):
-    """Returns the name of an AST node's class."""
-    if isinstance(node, ast.AST):
-        return node.__class__.__name__
-
-def for_each_child(node, callback):
-    """Calls the callback for each AST node that's a child of the given node."""
-    for name in node._fields:
-        value = getattr(node, name)
-        if isinstance(value, list):
-            for item in value:
-                if isinstance(item, ast.AST):
-                    callback(item)
-        elif isinstance(value, ast.AST):
-            callback(value)
+# Directories that never hold modules of the tree itself.  Hidden directories
+# (e.g. .git, .tox) and virtual environments, which are recognized by their
+# pyvenv.cfg file, are skipped as well.
+SKIPPED_DIR_NAMES = frozenset(['__pycache__', 'site-packages'])
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'star-destroyer')
+STAR_NAMES_CACHE_PATH = os.path.join(CACHE_DIR, 'star_names.pickle')
+MODULE_CACHE_PATH = os.path.join(CACHE_DIR, 'modules.pickle')
+
+# Identifies what the module cache holds.  Bump the number whenever the
+# results of scan_file change, so that a cache written by an older version is
+# discarded instead of reused.
+MODULE_CACHE_FORMAT = (__version__, 1)
+
+# Starting a worker process can take as long as scanning a dozen typical
+# files, so each worker is given at least this many files to scan; with fewer
+# files in all, they are scanned in this process.
+MIN_FILES_PER_WORKER = 32
+
+def get_file_version(path):
+    """Gets a value that changes whenever the given file is modified."""
+    stat = os.stat(path)
+    return (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+
+def load_pickle(path, default):
+    """Loads a pickled value from a file, or returns a default on failure."""
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except Exception:
+        return default
+
+def save_pickle(path, value):
+    """Atomically writes a pickled value to a file, if possible."""
+    try:
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        fd, temp_path = tempfile.mkstemp(dir=dir_path)
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(value, file, 2)
+        getattr(os, 'replace', os.rename)(temp_path, path)
+    except (IOError, OSError):
+        print('WARNING: Could not write %s' % path, file=sys.stderr)
 
 def resolve_frompath(pkgpath, relpath, level=0):
     """Resolves the path of the module referred to by 'from ..x import y'."""
-    if level == 0:
+    if not level:
         return relpath
-    parts = pkgpath.split('.') + ['_']
-    parts = parts[:-level] + (relpath.split('.') if relpath else [])
-    return '.'.join(parts)
+    for i in range(level - 1):
+        pkgpath = pkgpath.rpartition('.')[0]
+    if relpath:
+        return pkgpath + '.' + relpath if pkgpath else relpath
+    return pkgpath
+
+def add_with_prefixes(dotted_paths, new_paths):
+    """Adds dotted paths to a set along with all their prefixes (a.b.c brings
+    in a.b and a), given that the set already contains the prefixes of all
+    its members."""
+    for path in new_paths:
+        # Once a path is found in the set, so are all its prefixes.
+        while path not in dotted_paths:
+            dotted_paths.add(path)
+            path, dot, name = path.rpartition('.')
+            if not dot:
+                break
+
+def format_import_from(node, names):
+    """Formats the source text of the given ImportFrom node, as though it
+    imported just the given names."""
+    return 'from %s%s import %s' % (
+        '.'*node.level, node.module or '', ', '.join(names))
+
+# The results of find_module, which hold only while sys.path is unchanged.
+FOUND_MODULE_PATHS = {}  # {tuple(sys.path): {modpath: path or None}}
 
 def find_module(modpath):
     """Determines whether a module exists with the given modpath."""
-    module_path = modpath.replace('.', '/') + '.py'
-    init_path = modpath.replace('.', '/') + '/__init__.py'
+    found_paths = FOUND_MODULE_PATHS.setdefault(tuple(sys.path), {})
+    if modpath not in found_paths:
+        found_paths[modpath] = search_sys_path(modpath)
+    return found_paths[modpath]
+
+DIR_NAMES = {}  # {dir_path: frozenset([name, ...])}
+
+def get_dir_names(dir_path):
+    """Gets the set of names in a directory, listing it only once."""
+    if dir_path not in DIR_NAMES:
+        try:
+            DIR_NAMES[dir_path] = frozenset(os.listdir(dir_path or os.curdir))
+        except OSError:
+            DIR_NAMES[dir_path] = frozenset()
+    return DIR_NAMES[dir_path]
+
+def search_sys_path(modpath):
+    """Looks in each sys.path directory for the module with a given modpath."""
+    # Directory listings rule out most candidates without a stat call.
+    parts = modpath.split('.')
+    name = parts.pop()
     for root_path in sys.path:
-        path = os.path.join(root_path, module_path)
-        if os.path.isfile(path):
-            return path
-        path = os.path.join(root_path, init_path)
-        if os.path.isfile(path):
-            return path
+        dir_path = os.path.join(root_path, *parts)
+        dir_names = get_dir_names(dir_path)
+        if name + '.py' in dir_names:
+            path = os.path.join(dir_path, name + '.py')
+            if os.path.isfile(path):
+                return path
+        if name in dir_names:
+            if '__init__.py' in get_dir_names(os.path.join(dir_path, name)):
+                path = os.path.join(dir_path, name, '__init__.py')
+                if os.path.isfile(path):
+                    return path
+
+def make_module_finder(known_paths):
+    """Makes a version of find_module that first looks in a {modpath: path}
+    dict of already known modules."""
+    known_paths = dict(known_paths)
+
+    def find_known_module(modpath):
+        return known_paths.get(modpath) or find_module(modpath)
+
+    return find_known_module
 
 
 class ImportMap:
@@ -89,18 +196,54 @@ class ImportMap:
     # in the module a, or the module b in the package a; these two things are
     # indistinguishable from the referring module.
 
-    def __init__(self, find_module, import_module):
-        self.map = {}  # {modpath: {name: {origin, ...}}}
+    def __init__(self, find_module, import_module, star_names_cache_path=None):
+        # A name with a single origin maps to it directly, instead of to a
+        # set, as this is by far the most common case.  Sets of origins are
+        # frozen and shared by share_origin_sets once all imports are added.
+        self.map = {}  # {modpath: {name: origin or set([origin, ...])}}
         self.star_names = {}  # {modpath: [name, ...]}
         self.find_module = find_module
         self.import_module = import_module
 
+        # Star names persist across runs, since getting them means importing
+        # (and thus running) the module.  The names can come from any module
+        # loaded at the time, including ones imported before it (e.g. the
+        # source of its own 'import *'), so an entry is reused only while the
+        # files of all the modules loaded after importing it are unchanged.
+        self.star_names_cache_path = star_names_cache_path
+        # {(modpath, path): ({path: version}, [name, ...])}
+        self.star_names_cache = (load_pickle(star_names_cache_path, {})
+                                 if star_names_cache_path else {})
+        self.star_names_cache_changed = False
+        self.file_versions = {}  # {path: version or None}, for this run
+
     def __repr__(self):
         return '<ImportMap>'
 
+    def get_file_versions(self, paths):
+        """Gets the versions of some files, or None for missing files."""
+        versions = {}
+        for path in paths:
+            if path not in self.file_versions:
+                try:
+                    self.file_versions[path] = get_file_version(path)
+                except OSError:
+                    self.file_versions[path] = None
+            versions[path] = self.file_versions[path]
+        return versions
+
     def get_star_names(self, modpath):
         """Returns all the names imported by 'import *' from a given module."""
         if modpath not in self.star_names:
+            path = self.find_module(modpath)
+            path = path and os.path.abspath(path)
+            key = (modpath, path)
+            if path and key in self.star_names_cache:
+                versions, names = self.star_names_cache[key]
+                if self.get_file_versions(versions) == versions:
+                    self.star_names[modpath] = names
+                    return names
+
             print('Importing %s to resolve import *' % modpath, file=sys.stderr)
             try:
                 module = self.import_module(modpath)
@@ -111,11 +254,53 @@ class ImportMap:
                 self.star_names[modpath] = sorted(getattr(
                     module, '__all__',
                     [name for name in dir(module) if not name.startswith('_')]))
+                if path and self.star_names_cache_path:
+                    paths = set([path])
+                    for loaded in list(sys.modules.values()):
+                        file_path = getattr(loaded, '__file__', None)
+                        if file_path:
+                            if file_path.endswith(('.pyc', '.pyo')):
+                                file_path = file_path[:-1]
+                            paths.add(os.path.abspath(file_path))
+                    self.star_names_cache[key] = (
+                        self.get_file_versions(paths), self.star_names[modpath])
+                    self.star_names_cache_changed = True
         return self.star_names[modpath]
 
+    def save_star_names_cache(self):
+        """Saves any newly found star names for use in later runs."""
+        if self.star_names_cache_changed:
+            save_pickle(self.star_names_cache_path, self.star_names_cache)
+            self.star_names_cache_changed = False
+
     def add(self, modpath, name, origin):
         """Adds a possible origin for the given name in the given module."""
-        self.map.setdefault(modpath, {}).setdefault(name, set()).add(origin)
+        names = self.map.get(modpath)
+        if names is None:
+            names = self.map[intern(modpath)] = {}
+        origins = names.get(name)
+        if origins is None:
+            names[intern(name)] = intern(origin)
+            return
+        origin = intern(origin)
+        if isinstance(origins, str):
+            if origins != origin:
+                names[name] = set([origins, origin])
+        elif origin not in origins:
+            if isinstance(origins, frozenset):
+                origins = names[name] = set(origins)
+            origins.add(origin)
+
+    def share_origin_sets(self):
+        """Replaces each set of origins with a frozenset, sharing one copy
+        among all the names with equal sets.  Call this after all imports
+        are added."""
+        shared_sets = {}
+        for names in self.map.values():
+            for name, origins in names.items():
+                if isinstance(origins, set):
+                    origins = frozenset(origins)
+                    names[name] = shared_sets.setdefault(origins, origins)
 
     def add_package_origins(self, modpath):
         """Whenever you 'import a.b.c', Python automatically binds 'b' in a to
@@ -128,49 +313,28 @@ class ImportMap:
                 self.add(parent, part, child)
             parent = child
 
-    def scan_module(self, pkgpath, modpath, node):
-        """Scans a module, collecting possible origins for all names, assuming
-        names can only become bound to values in other modules by import."""
-
-        def scan_imports(node):
-            if node_type(node) == 'Import':
-                for binding in node.names:
-                    name, asname = binding.name, binding.asname
-                    if asname:
-                        self.add(modpath, asname, name)
-                    else:
-                        top_name = name.split('.')[0]
-                        self.add(modpath, top_name, top_name)
-                    self.add_package_origins(name)
-
-            elif node_type(node) == 'ImportFrom':
-                frompath = resolve_frompath(pkgpath, node.module, node.level)
-                for binding in node.names:
-                    name, asname = binding.name, binding.asname
-                    if name == '*':
-                        for name in self.get_star_names(frompath):
-                            self.add(modpath, name, frompath + '.' + name)
-                        self.add_package_origins(frompath)
-                    else:
-                        self.add(modpath, asname or name, frompath + '.' + name)
-                        self.add_package_origins(frompath + '.' + name)
-
-            else:
-                for_each_child(node, scan_imports)
-
-        for_each_child(node, scan_imports)
-
     def get_origins(self, modpath, name):
-        """Returns the set of possible origins for a name in a module."""
-        return self.map.get(modpath, {}).get(name, set())
+        """Returns a collection of possible origins for a name in a module."""
+        names = self.map.get(modpath)
+        if names is None:
+            return ()
+        origins = names.get(name, ())
+        return (origins,) if isinstance(origins, str) else origins
+
+    def export(self):
+        """Returns the import map as {modpath: {name: {origin, ...}}}."""
+        return dict((modpath, dict((name, set(self.get_origins(modpath, name)))
+                                   for name in names))
+                    for modpath, names in self.map.items())
 
     def dump(self):
         """Prints out the contents of the import map."""
         for modpath in sorted(self.map):
             title = 'Imports in %s' % modpath
             print('\n' + title + '\n' + '-'*len(title))
-            for name, value in sorted(self.map.get(modpath, {}).items()):
-                print('  %s -> %s' % (name, ', '.join(sorted(value))))
+            for name in sorted(self.map[modpath]):
+                origins = self.get_origins(modpath, name)
+                print('  %s -> %s' % (name, ', '.join(sorted(origins))))
 
 
 class UsageMap:
@@ -179,64 +343,58 @@ class UsageMap:
     def __init__(self, import_map):
         self.import_map = import_map
         self.map = {}
+        self.origins_cache = {}  # {(modpath, name): frozenset([origin, ...])}
 
     def __repr__(self):
         return '<UsageMap>'
 
-    def scan_module(self, modpath, node):
-        """Scans a module, collecting all used origins, assuming that modules
-        are obtained only by dotted paths and no other kinds of expressions."""
-
-        used_origins = self.map.setdefault(modpath, set())
-
-        def get_origins(modpath, name):
-            """Returns the chain of all origins for a given name in a module."""
+    def get_origins(self, modpath, name):
+        """Returns the chain of all origins for a given name in a module."""
+        # The import map is complete before any usage is scanned, so the
+        # chain for each name can be computed once and shared by all modules.
+        cache = self.origins_cache
+        key = (modpath, name)
+        if key not in cache:
             origins = set()
-
-            def walk_origins(modpath, name):
-                for origin in self.import_map.get_origins(modpath, name):
+            import_origins = self.import_map.get_origins
+            stack = [key]
+            while stack:
+                for origin in import_origins(*stack.pop()):
                     if origin not in origins:
                         origins.add(origin)
-                        if '.' in origin:
-                            walk_origins(*origin.rsplit('.', 1))
-
-            walk_origins(modpath, name)
-            return origins
-
-        def get_origins_for_node(node):
-            """Returns the set of all possible origins to which the given
-            dotted-path expression might dereference."""
-            if node_type(node) == 'Name' and node_type(node.ctx) == 'Load':
-                return {modpath + '.' + node.id} | get_origins(modpath, node.id)
-            if node_type(node) == 'Attribute' and node_type(node.ctx) == 'Load':
-                return set.union(set(), *[
-                    {parent + '.' + node.attr} | get_origins(parent, node.attr)
-                    for parent in get_origins_for_node(node.value)])
-            return set()
-
-        def get_origins_used_by_node(node):
-            """Returns the set of all possible origins that could be used
-            during dereferencing of the given dotted-path expression."""
-            if node_type(node) == 'Name':
-                return get_origins_for_node(node)
-            if node_type(node) == 'Attribute':
-                return set.union(get_origins_used_by_node(node.value),
-                                 get_origins_for_node(node))
-            return set()
-
-        def scan_loads(node):
-            if node_type(node) in ['Name', 'Attribute']:
-                used_origins.update(get_origins_used_by_node(node))
-            for_each_child(node, scan_loads)
-
-        for_each_child(node, scan_loads)
-
-        intermediate_origins = set()
-        for origin in used_origins:
-            parts = origin.split('.')
-            for i in range(1, len(parts)):
-                intermediate_origins.add('.'.join(parts[:i]))
-        used_origins.update(intermediate_origins)
+                        parent, dot, attr = origin.rpartition('.')
+                        if dot:
+                            # A cached chain is complete, so it can be
+                            # taken whole instead of walked again.
+                            chain = cache.get((parent, attr))
+                            if chain is None:
+                                stack.append((parent, attr))
+                            else:
+                                origins.update(chain)
+            cache[key] = frozenset(origins)
+        return cache[key]
+
+    def scan_refs(self, modpath, refs):
+        """Collects all the origins used by a module, given the dotted paths
+        loaded in it, as tuples of names."""
+
+        used_origins = self.map.setdefault(modpath, set())
+        get_origins = self.get_origins
+        prefix = modpath + '.'
+
+        for path in refs:
+            # Resolve each dotted path in turn, from a to a.b.c, using the
+            # origins of the previous one.
+            name = path[0]
+            origins = {prefix + name} | get_origins(modpath, name)
+            add_with_prefixes(used_origins, origins)
+            for attr in path[1:]:
+                suffix = '.' + attr
+                parents, origins = origins, set()
+                for parent in parents:
+                    origins.add(parent + suffix)
+                    origins.update(get_origins(parent, attr))
+                add_with_prefixes(used_origins, origins)
 
     def get_used_origins(self, modpath):
         return self.map.get(modpath, set())
@@ -253,98 +411,327 @@ class UsageMap:
                 print('  %s' % origin)
 
 
-class StarDestroyer:
-    def __init__(self, import_map, usage_map):
-        self.import_map = import_map
-        self.usage_map = usage_map
-        self.all_used = set.union(*(usage_map.get_used_origins(modpath)
-                                    for modpath in usage_map.get_modpaths()))
-
-    def edit_module(self, pkgpath, modpath, path, node, actually_write=False):
-        lines = open(path).readlines()
-        original_lines = lines[:]
-
-        import_stars = []
+class ImportVisitor(ast.NodeVisitor):
+    """Adds the origins of all names bound by the given import nodes to an
+    ImportMap."""
 
-        def find_import_stars(node):
-            if node_type(node) == 'ImportFrom':
-                for binding in node.names:
-                    if binding.name == '*':
-                        import_stars.append(node)
+    def __init__(self, import_map, pkgpath, modpath):
+        self.import_map = import_map
+        self.pkgpath = pkgpath
+        self.modpath = modpath
+
+    def visit_Import(self, node):
+        import_map, modpath = self.import_map, self.modpath
+        for binding in node.names:
+            name, asname = binding.name, binding.asname
+            if asname:
+                import_map.add(modpath, asname, name)
             else:
-                for_each_child(node, find_import_stars)
-
-        for_each_child(node, find_import_stars)
+                top_name = name.split('.')[0]
+                import_map.add(modpath, top_name, top_name)
+            import_map.add_package_origins(name)
+
+    def visit_ImportFrom(self, node):
+        import_map, modpath = self.import_map, self.modpath
+        frompath = resolve_frompath(self.pkgpath, node.module, node.level)
+        prefix = frompath + '.'
+        for binding in node.names:
+            name, asname = binding.name, binding.asname
+            if name == '*':
+                for name in import_map.get_star_names(frompath):
+                    import_map.add(modpath, name, prefix + name)
+                import_map.add_package_origins(frompath)
+            else:
+                origin = prefix + name
+                import_map.add(modpath, asname or name, origin)
+                import_map.add_package_origins(origin)
+
+
+class SourceVisitor:
+    """Collects the import statements in a module and the set of dotted paths
+    loaded in it, as tuples of names.  Only the longest path in a chain like
+    a.b.c is collected, as ('a', 'b', 'c'), since loading it also loads a and
+    a.b.  Nothing is resolved, so the results depend only on the module's
+    source and can be collected in another process or cached."""
+
+    def __init__(self):
+        self.imports = []
+        self.refs = set()
+
+    def visit(self, node):
+        # This walks every node of every module, so it uses an explicit
+        # stack instead of a Python call per node, and reads fields directly.
+        imports, add_ref = self.imports, self.refs.add
+        stack = [node]
+        pop, push = stack.pop, stack.append
+        while stack:
+            node = pop()
+            cls = node.__class__
+            if cls is ast.Name:
+                if isinstance(node.ctx, ast.Load):
+                    add_ref((node.id,))
+            elif cls is ast.Attribute:
+                base = self.add_attribute_ref(node)
+                if base:
+                    push(base)
+            elif cls is ast.Import or cls is ast.ImportFrom:
+                imports.append(node)
+            else:
+                # Push children in reverse, so they are visited in order.
+                for name in reversed(cls._fields):
+                    value = getattr(node, name, None)
+                    if isinstance(value, list):
+                        for item in reversed(value):
+                            if isinstance(item, ast.AST):
+                                push(item)
+                    elif isinstance(value, ast.AST):
+                        push(value)
+
+    def add_attribute_ref(self, node):
+        """Collects the dotted path in an Attribute chain.  If the chain is
+        not a dotted path, e.g. f().b.c, returns its base expression, f(),
+        which still needs visiting."""
+        names = []
+        base = node
+        while isinstance(base, ast.Attribute):
+            names.append(base.attr)
+            base = base.value
+        if not isinstance(base, ast.Name):
+            return base
+        names.append(base.id)
+        if not isinstance(node.ctx, ast.Load):
+            names.pop(0)  # a.b.c = x stores c, but loads a.b
+        self.refs.add(tuple(reversed(names)))
 
-        if import_stars:
-            print('\n--- %s ---' % path, file=sys.stderr)
 
+class StarDestroyer:
+    def __init__(self, import_map, usage_map):
+        self.import_map = import_map
+        self.usage_map = usage_map
+        all_used = set(itertools.chain.from_iterable(
+            usage_map.get_used_origins(modpath)
+            for modpath in usage_map.get_modpaths()))
+        self.used_names = {}  # {modpath: {name, ...}} for used modpath.name
+        for origin in all_used:
+            modpath, dot, name = origin.rpartition('.')
+            if dot:
+                self.used_names.setdefault(modpath, set()).add(name)
+
+    def edit_module(self, pkgpath, modpath, path, import_stars,
+                    actually_write=False):
+        """Edits the given 'import *' nodes in a module to import only the
+        names that are used."""
+        if not import_stars:
+            return
+
+        with open(path, 'rb') as file:
+            source = file.read()
+
+        # AST column offsets count bytes, so the edits are made on bytes.
+        line_starts = [0]
+        newline = source.find(b'\n')
+        while newline >= 0:
+            line_starts.append(newline + 1)
+            newline = source.find(b'\n', newline + 1)
+
+        print('\n--- %s ---' % path, file=sys.stderr)
+
+        edits = []  # [(start, end, replacement), ...]
+        used_names = self.used_names.get(modpath, ())
         for node in import_stars:
             frompath = resolve_frompath(pkgpath, node.module, node.level)
-            ln = node.lineno - 1
-            start = node.col_offset
-
-            orig = original_lines[ln]
-            end = orig.index('*') + 1
+            start = line_starts[node.lineno - 1] + node.col_offset
+            end = source.index(b'*', start) + 1
             names = [name for name in self.import_map.get_star_names(frompath)
-                     if modpath + '.' + name in self.all_used]
-            imp = ('from %s import %s' %
-                   ('.'*node.level + node.module, ', '.join(names))
-                   if names else '')
-            print('%s  ==>  %s' % (orig[start:end], imp or '(deleted)'),
-                  file=sys.stderr)
-            lines[ln] = (orig[:start] + imp + orig[end:]).rstrip()
-            lines[ln] += '\n' if lines[ln] else ''
-
-        if lines != original_lines:
+                     if name in used_names]
+            imp = format_import_from(node, names) if names else ''
+            print('%s  ==>  %s' % (source[start:end].decode('utf-8'),
+                                   imp or '(deleted)'), file=sys.stderr)
+            # Drop any blanks left between the '*' and the end of the line.
+            line_end = source.find(b'\n', end)
+            line_end = len(source) if line_end < 0 else line_end
+            blanks = source[end:line_end].rstrip(b'\r')
+            if not blanks.strip():
+                end += len(blanks)
+            if not imp:
+                # Remove the whole line if nothing else is on it.
+                line_start = source.rfind(b'\n', 0, start) + 1
+                line_end = source.find(b'\n', end)
+                line_end = len(source) if line_end < 0 else line_end + 1
+                rest = source[line_start:start] + source[end:line_end]
+                if not rest.strip():
+                    start, end = line_start, line_end
+            edits.append((start, end, imp.encode('utf-8')))
+
+        parts = []
+        pos = 0
+        for start, end, replacement in sorted(edits):
+            parts += [source[pos:start], replacement]
+            pos = end
+        parts.append(source[pos:])
+        edited = b''.join(parts)
+
+        if edited != source:
             if actually_write:
-                with open(path, 'w') as file:
-                    file.write(''.join(lines))
+                with open(path, 'wb') as file:
+                    file.write(edited)
             return True
 
 
-def get_modules(root_path):
-    """Gets (pkgpath, modpath, path, ast) for all modules in a file tree."""
-    for dir_path, dir_names, file_names in os.walk(root_path):
-        assert dir_path[:len(root_path)] == root_path
-        subdir_path = dir_path[len(root_path):]
-        package_parts = list(filter(lambda x: x, subdir_path.split('/')))
-        for name in file_names:
-            if name.endswith('.py'):
-                path = os.path.join(dir_path, name)
-                pkgpath = '.'.join(package_parts)
-                modpath = (pkgpath if name == '__init__.py' else
-                           '.'.join(package_parts + [name[:-3]]))
-                try:
-                    node = ast.parse(open(path).read())
-                except SyntaxError:
-                    print('ERROR: Invalid syntax in %s' % path, file=sys.stderr)
-                else:
-                    yield (pkgpath, modpath, path, node)
-
-def scan(root_path):
-    modules = list(get_modules(root_path))
-
-    # Scan all the modules and collect a map of origins.
+def list_dir(dir_path):
+    """Gets (name, is_dir) for the entries in a directory, where is_dir is
+    true only for real directories, not symlinks to them."""
+    if hasattr(os, 'scandir'):
+        return [(entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in os.scandir(dir_path)]
+    return [(name, os.path.isdir(path) and not os.path.islink(path))
+            for name, path in ((name, os.path.join(dir_path, name))
+                               for name in os.listdir(dir_path))]
+
+def find_module_paths(root_path, package_parts=()):
+    """Gets (pkgpath, modpath, path) for all modules in a file tree."""
+    pkgpath = '.'.join(package_parts)
+    try:
+        entries = list_dir(root_path)
+    except OSError:
+        print('WARNING: Could not list %s' % root_path, file=sys.stderr)
+        return
+    if package_parts and ('pyvenv.cfg', False) in entries:
+        return
+    subdir_names = []
+    for name, is_dir in entries:
+        if is_dir:
+            if not (name.startswith('.') or name in SKIPPED_DIR_NAMES):
+                subdir_names.append(name)
+        elif name.endswith('.py'):
+            path = os.path.join(root_path, name)
+            modpath = (pkgpath if name == '__init__.py' else
+                       '.'.join(package_parts + (name[:-3],)))
+            yield (pkgpath, modpath, path)
+    for name in subdir_names:
+        for module_path in find_module_paths(
+            os.path.join(root_path, name), package_parts + (name,)):
+            yield module_path
+
+def read_source(path):
+    """Reads the contents of a source file as bytes."""
+    with open(path, 'rb') as file:
+        return file.read()
+
+def scan_file(path):
+    """Parses a source file, returning the (imports, refs) collected from it
+    by a SourceVisitor, or None if its syntax is invalid."""
+    source = read_source(path)
+    try:
+        node = ast.parse(source, filename=path)
+    except SyntaxError:
+        return None
+    visitor = SourceVisitor()
+    visitor.visit(node)
+    return visitor.imports, visitor.refs
+
+def get_cpu_count():
+    """Gets the number of CPUs, or 1 if it can't be determined."""
+    # os.cpu_count is missing in Python 2, even with the futures backport.
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def scan_files(paths):
+    """Gets the results of scan_file for each of the given paths, in order,
+    spreading the work over all CPUs when there are enough files."""
+    # Only the small results of the scan cross between processes; passing
+    # back whole ASTs would cost more to unpickle than to parse.
+    if ProcessPoolExecutor:
+        workers = min(get_cpu_count(), len(paths) // MIN_FILES_PER_WORKER)
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                return list(executor.map(scan_file, paths, chunksize=8))
+    return list(map(scan_file, paths))
+
+def scan(root_path, star_names_cache_path=None, module_cache_path=None):
+    """Scans all the modules in a file tree, returning the list of modules
+    as (pkgpath, modpath, path, import_stars), an ImportMap, and a UsageMap.
+    Each file is reduced to its import nodes and the dotted paths it loads.
+    These depend only on the file's contents, so with a module_cache_path
+    they are also saved for reuse in later runs for unchanged files."""
+    module_paths = list(find_module_paths(root_path))
+
+    # The saved nodes differ between Python versions, so entries are also
+    # keyed by the version that made them.  The whole cache is dropped if it
+    # was written in another format.
+    # {(python_version, abspath): (version, [import node, ...], {path, ...})}
+    saved = load_pickle(module_cache_path, None) if module_cache_path else None
+    module_cache = {}
+    if isinstance(saved, tuple) and saved[0] == MODULE_CACHE_FORMAT:
+        module_cache = saved[1]
+    python_version = sys.version_info[:2]
+    versions = {}
+    changed_paths = []
+    for (pkgpath, modpath, path) in module_paths:
+        abspath = os.path.abspath(path)
+        versions[abspath] = get_file_version(path)
+        entry = module_cache.get((python_version, abspath))
+        if not (entry and entry[0] == versions[abspath]):
+            changed_paths.append(path)
+    for path, result in zip(changed_paths, scan_files(changed_paths)):
+        abspath = os.path.abspath(path)
+        if result:
+            imports, refs = result
+            module_cache[python_version, abspath] = (
+                versions[abspath], imports, refs)
+        else:
+            print('ERROR: Invalid syntax in %s' % path, file=sys.stderr)
+            module_cache.pop((python_version, abspath), None)
+
+    # Drop the entries for files that are no longer in the tree.
+    root_prefix = os.path.join(os.path.abspath(root_path), '')
+    removed_keys = [key for key in module_cache
+                    if key[1].startswith(root_prefix) and key[1] not in versions]
+    for key in removed_keys:
+        del module_cache[key]
+    if module_cache_path and (changed_paths or removed_keys):
+        save_pickle(module_cache_path, (MODULE_CACHE_FORMAT, module_cache))
+
+    # Collect a map of origins from the imports in all the modules.
+    # The modules under root_path have just been found, so lookups of them
+    # need not touch the filesystem again.
     sys.path.append(root_path)
-    import_map = ImportMap(find_module, importlib.import_module)
-    for (pkgpath, modpath, path, node) in modules:
-        # print('Scanning: %s' % modpath, file=sys.stderr)
-        import_map.scan_module(pkgpath, modpath, node)
-
-    # Scan all the modules and look at all the names loaded.
+    find_scanned_module = make_module_finder(
+        (modpath, path) for (pkgpath, modpath, path) in module_paths)
+    import_map = ImportMap(find_scanned_module, importlib.import_module,
+                           star_names_cache_path)
+    modules = []
+    module_refs = []
+    for (pkgpath, modpath, path) in module_paths:
+        entry = module_cache.get((python_version, os.path.abspath(path)))
+        if entry:
+            version, imports, refs = entry
+            visitor = ImportVisitor(import_map, pkgpath, modpath)
+            for node in imports:
+                visitor.visit(node)
+            import_stars = [
+                node for node in imports if isinstance(node, ast.ImportFrom)
+                and any(binding.name == '*' for binding in node.names)]
+            modules.append((pkgpath, modpath, path, import_stars))
+            module_refs.append((modpath, refs))
+
+    # Resolve all the names loaded, now that all the imports are known.
+    import_map.save_star_names_cache()
+    import_map.share_origin_sets()
     usage_map = UsageMap(import_map)
-    for (pkgpath, modpath, path, node) in modules:
-        usage_map.scan_module(modpath, node)
+    for (modpath, refs) in module_refs:
+        usage_map.scan_refs(modpath, refs)
 
     return modules, import_map, usage_map
 
 def edit(modules, import_map, usage_map, actually_write=False):
     # Finally, edit the 'import *' lines in all the modules.
     star_destroyer = StarDestroyer(import_map, usage_map)
-    for (pkgpath, modpath, path, node) in modules:
+    for (pkgpath, modpath, path, import_stars) in modules:
         if star_destroyer.edit_module(
-            pkgpath, modpath, path, node, actually_write):
+            pkgpath, modpath, path, import_stars, actually_write):
             if actually_write:
                 print('Edited %s' % path, file=sys.stderr)
 
@@ -358,6 +745,11 @@ def show_results(modules, import_map, usage_map):
 
 if __name__ == '__main__':
     args = sys.argv[1:]
+    cache_paths = (STAR_NAMES_CACHE_PATH, MODULE_CACHE_PATH)
+    if '--no-cache' in args:
+        args.remove('--no-cache')
+        cache_paths = (None, None)
+
     if not args or '-h' in args or '--help' in args:
         print(__doc__)
 
@@ -365,21 +757,20 @@ if __name__ == '__main__':
         args.pop(args.index('-t'))
         [root_path, import_map_path, usage_map_path] = args
 
-        import pickle
         modules, import_map, usage_map = scan(root_path)
         with open(import_map_path, 'wb') as out:
-            pickle.dump(import_map.map, out)
+            pickle.dump(import_map.export(), out)
         with open(usage_map_path, 'wb') as out:
             pickle.dump(usage_map.map, out)
 
     elif '-e' in args:
         args.pop(args.index('-e'))
         [root_path] = args
-        modules, import_map, usage_map = scan(root_path)
+        modules, import_map, usage_map = scan(root_path, *cache_paths)
         edit(modules, import_map, usage_map, actually_write=True)
 
     else:
         [root_path] = args
-        modules, import_map, usage_map = scan(root_path)
+        modules, import_map, usage_map = scan(root_path, *cache_paths)
         show_results(modules, import_map, usage_map)
         edit(modules, import_map, usage_map, actually_write=False)
@@ -1,8 +1,12 @@
+import ast
 import json
 import os
 import pickle
 import pprint
 import pytest
+import shutil
+import star_destroyer
+import subprocess
 import sys
 import tempfile
 
@@ -17,6 +21,12 @@ for name in os.listdir(CASES_PATH):
         os.path.isfile(os.path.join(path, 'expected_usage'))):
         CASE_DIRS.append(path)
 
+EDIT_CASE_DIRS = []
+for name in os.listdir(CASES_PATH):
+    path = os.path.join(CASES_PATH, name)
+    if os.path.isdir(os.path.join(path, 'expected_edits')):
+        EDIT_CASE_DIRS.append(path)
+
 @pytest.mark.parametrize('path', CASE_DIRS)
 def test_scanner(path):
     print('running: %s' % path)
@@ -48,3 +58,153 @@ def test_scanner(path):
     assert expected_imports == actual_imports
     assert expected_usage == actual_usage
     print('passed: %s' % path)
+
+def run_program(args, cache_path):
+    """Runs star_destroyer with the given cache directory, returning stderr."""
+    env = dict(os.environ, XDG_CACHE_HOME=cache_path,
+               PYTHONDONTWRITEBYTECODE='1')
+    process = subprocess.Popen([sys.executable, PROGRAM_PATH] + args, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    return stderr.decode('utf-8')
+
+def write_file(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+def test_star_names_cache(tmpdir):
+    root_path = str(tmpdir.mkdir('tree'))
+    cache_path = str(tmpdir.join('cache'))
+    write_file(os.path.join(root_path, 'lib1.py'), 'alpha = beta = 1\n')
+    write_file(os.path.join(root_path, 'lib2.py'), 'from lib1 import *\n')
+    write_file(os.path.join(root_path, 'main.py'), 'from lib1 import *\n'
+               'from lib2 import *\nprint(alpha, beta, gamma)\n')
+    output = run_program([root_path], cache_path)
+    assert 'from lib2 import alpha, beta\n' in output
+
+    # lib2 gets its names from lib1, which was imported before lib2 was.
+    write_file(os.path.join(root_path, 'lib1.py'), 'alpha = beta = gamma = 1\n')
+    output = run_program([root_path], cache_path)
+    assert 'from lib2 import alpha, beta, gamma\n' in output
+
+    # With nothing changed, no module needs to be imported again.
+    output = run_program([root_path], cache_path)
+    assert 'Importing' not in output
+    assert 'from lib2 import alpha, beta, gamma\n' in output
+
+def read_files(root_path):
+    """Gets {relative path: contents} for all the files in a tree."""
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(root_path):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            with open(path, 'rb') as file:
+                files[os.path.relpath(path, root_path)] = file.read()
+    return files
+
+@pytest.mark.parametrize('path', EDIT_CASE_DIRS)
+def test_editor(path, tmpdir):
+    print('running: %s' % path)
+    root_path = str(tmpdir.join('tree'))
+    shutil.copytree(path, root_path,
+                    ignore=shutil.ignore_patterns('expected_edits'))
+    # Files without an expected edit should be left as they were.
+    expected_files = read_files(root_path)
+    run_program(['-e', root_path], str(tmpdir.join('cache')))
+
+    expected_files.update(read_files(os.path.join(path, 'expected_edits')))
+    actual_files = read_files(root_path)
+    for name in sorted(expected_files):
+        print('expected %s: %r' % (name, expected_files[name]))
+        print('  actual %s: %r' % (name, actual_files[name]))
+    assert expected_files == actual_files
+    print('passed: %s' % path)
+
+def test_module_cache(tmpdir, monkeypatch):
+    root_path = str(tmpdir.mkdir('tree'))
+    cache_path = str(tmpdir.join('modules.pickle'))
+    write_file(os.path.join(root_path, 'a.py'), 'import b\n\ny = b.x\n')
+    write_file(os.path.join(root_path, 'b.py'), 'x = 1\n')
+
+    scanned_names = []
+    scan_files = star_destroyer.scan_files
+    def record_scan_files(paths):
+        scanned_names.extend(sorted(os.path.basename(path) for path in paths))
+        return scan_files(paths)
+    monkeypatch.setattr(star_destroyer, 'scan_files', record_scan_files)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+
+    def scan():
+        del scanned_names[:]
+        modules, import_map, usage_map = star_destroyer.scan(
+            root_path, None, cache_path)
+        return scanned_names, usage_map.map
+
+    scanned, usage = scan()
+    assert scanned == ['a.py', 'b.py']
+    assert 'b.x' in usage['a']
+
+    # Unchanged files are not scanned again, and give the same results.
+    assert scan() == ([], usage)
+
+    # A changed file is scanned again.
+    write_file(os.path.join(root_path, 'a.py'), 'import b\n\ny = b.z\n')
+    scanned, usage = scan()
+    assert scanned == ['a.py']
+    assert 'b.z' in usage['a'] and 'b.x' not in usage['a']
+
+    # The entry for a deleted file is removed.
+    os.remove(os.path.join(root_path, 'b.py'))
+    assert scan()[0] == []
+    with open(cache_path, 'rb') as file:
+        cache_format, cache = pickle.load(file)
+    assert cache_format == star_destroyer.MODULE_CACHE_FORMAT
+    assert sorted(cache) == [
+        (sys.version_info[:2], os.path.join(root_path, 'a.py'))]
+
+    # A cache written in another format is not used.
+    monkeypatch.setattr(star_destroyer, 'MODULE_CACHE_FORMAT', ('0.0', 0))
+    assert scan()[0] == ['a.py']
+
+@pytest.mark.skipif(star_destroyer.ProcessPoolExecutor is None,
+                    reason='concurrent.futures is not available')
+def test_parallel_scan(monkeypatch):
+    paths = [path for pkgpath, modpath, path in
+             star_destroyer.find_module_paths(CASES_PATH)]
+    expected = [(list(map(ast.dump, imports)), refs)
+                for imports, refs in map(star_destroyer.scan_file, paths)]
+
+    pool_sizes = []
+    executor_class = star_destroyer.ProcessPoolExecutor
+    def make_executor(workers):
+        pool_sizes.append(workers)
+        return executor_class(workers)
+    monkeypatch.setattr(star_destroyer, 'ProcessPoolExecutor', make_executor)
+    monkeypatch.setattr(star_destroyer, 'MIN_FILES_PER_WORKER', 1)
+    monkeypatch.setattr(star_destroyer, 'get_cpu_count', lambda: 2)
+
+    actual = [(list(map(ast.dump, imports)), refs)
+              for imports, refs in star_destroyer.scan_files(paths)]
+    assert pool_sizes == [2]
+    assert expected == actual
+
+def test_unlistable_dir(tmpdir, monkeypatch):
+    root_path = str(tmpdir)
+    write_file(os.path.join(root_path, 'a.py'), 'x = 1\n')
+    os.mkdir(os.path.join(root_path, 'perm'))
+    write_file(os.path.join(root_path, 'perm', 'b.py'), 'y = 1\n')
+    os.mkdir(os.path.join(root_path, 'pkg'))
+    write_file(os.path.join(root_path, 'pkg', 'c.py'), 'z = 1\n')
+
+    list_dir = star_destroyer.list_dir
+    def list_dir_except_perm(dir_path):
+        if os.path.basename(dir_path) == 'perm':
+            raise OSError(13, 'Permission denied', dir_path)
+        return list_dir(dir_path)
+    monkeypatch.setattr(star_destroyer, 'list_dir', list_dir_except_perm)
+
+    # The directory that can't be listed is skipped, like os.walk does.
+    modpaths = [modpath for pkgpath, modpath, path in
+                star_destroyer.find_module_paths(root_path)]
+    assert sorted(modpaths) == ['a', 'pkg.c']